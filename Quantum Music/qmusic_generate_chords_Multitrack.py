@@ -1,9 +1,21 @@
 import numpy as np
 from qiskit import QuantumCircuit
 from qiskit_aer import AerSimulator
-from pythonosc import udp_client
+from pythonosc import udp_client, osc_message_builder, osc_server
+from pythonosc.dispatcher import Dispatcher
+from pythonosc.parsing import osc_types
 import time
 import keyboard
+import ctypes
+import errno
+import os
+import select
+import socket
+import struct
+import threading
+import queue
+import sys
+import functools
 
 # --- 1. CONFIGURATION ---
 TEMPO = 120
@@ -18,154 +30,377 @@ CHORDS = [
 NOTES_PER_CHORD = 16  # Fixed count per bar, but durations are randomized
 CHORD_DURATION = 8.0  # Duration of one bar in beats
 DURATIONS = [0, 0.5, 0.75, 1.0, 2.0] # Possible note lengths
+USE_QUANTUM = True    # False draws from NumPy's classical PRNG instead of simulating circuits
+
+# Lookup tables for vectorized note generation
+EXTENDED_CHORDS = np.array([chord + [chord[0] + 12] for chord in CHORDS], dtype=np.int16)  # Triad + Octave root
+DURATION_VALUES = np.array(DURATIONS, dtype=np.float32)
 
 # Ableton OSC Config
 ABLETON_IP = "127.0.0.1"
 ABLETON_PORT = 11000
+ABLETON_REPLY_PORT = 11001   # AbletonOSC sends query replies to this port
+QUERY_INTERVAL = 0.02        # Seconds between re-sent queries while waiting on Ableton
+OSC_SEND_BUFFER = 1 << 20    # SO_SNDBUF for the OSC socket, so note bursts never fill it
+OSC_MAX_DATAGRAM = 1472      # Largest UDP payload that avoids IP fragmentation (Ethernet MTU)
+# Big-endian OSC arguments of one note in an add-notes message (mute is a type tag only, with no payload)
+NOTE_FIELDS = [("pitch", ">i4"), ("start", ">f4"), ("duration", ">f4"), ("velocity", ">i4")]
 INITIAL_TRACK_INDEX = 0      # Track to place the clip (0-indexed)
 CLIP_INDEX = 0       # Clip slot to place the clip (0-indexed)
 LENGTH = 4           # Number of bars (chords) per clip
+DEBOUNCE_SECONDS = 0.25  # Space presses closer together than this (e.g. key auto-repeat) are ignored
 
 # Global track counter
 current_track_index = INITIAL_TRACK_INDEX
 
+# Keypress hand-off: at most one generation waits while another one runs
+_last_trigger = 0.0
+_generate_requests = queue.Queue(maxsize=1)
+
 # --- 2. ABLETON OSC CLIENT ---
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_ushort),
+        ("sin_addr", ctypes.c_ubyte * 4),
+        ("sin_zero", ctypes.c_ubyte * 8),
+    ]
+
+_libc = ctypes.CDLL(None, use_errno=True) if sys.platform == "linux" else None
+
+@functools.lru_cache(maxsize=None)
+def _sockaddr_in(host, port):
+    """Resolves 'host' once and caches the sockaddr_in that sendmmsg() points at."""
+    dest = _SockAddrIn(socket.AF_INET, socket.htons(port))
+    dest.sin_addr[:] = socket.inet_aton(socket.gethostbyname(host))
+    return dest
+
+def _send_datagrams(sock, addr, datagrams):
+    """
+    Sends a list of datagrams to 'addr'.
+    On Linux a single sendmmsg() call hands a multi-datagram batch to the kernel; a lone datagram, or any
+    datagram on other platforms, goes through plain sendto().
+    The socket may be non-blocking: if the send buffer is full, wait until it is writable and retry.
+    """
+    if len(datagrams) == 1 or _libc is None or sock.family != socket.AF_INET:
+        for dgram in datagrams:
+            while True:
+                try:
+                    sock.sendto(dgram, addr)
+                    break
+                except BlockingIOError:
+                    select.select([], [sock], [])
+        return
+
+    n = len(datagrams)
+    dest = _sockaddr_in(*addr)
+    buffers = [ctypes.create_string_buffer(dgram, len(dgram)) for dgram in datagrams]
+    iovecs = (_IOVec * n)()
+    msgs = (_MMsgHdr * n)()
+    for i, buf in enumerate(buffers):
+        iovecs[i].iov_base = ctypes.addressof(buf)
+        iovecs[i].iov_len = len(datagrams[i])
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = ctypes.addressof(dest)
+        hdr.msg_namelen = ctypes.sizeof(dest)
+        hdr.msg_iov = ctypes.pointer(iovecs[i])
+        hdr.msg_iovlen = 1
+
+    # sendmmsg() may accept fewer messages than requested, so resubmit the remainder
+    sent = 0
+    while sent < n:
+        ret = _libc.sendmmsg(sock.fileno(), ctypes.byref(msgs, sent * ctypes.sizeof(_MMsgHdr)), n - sent, 0)
+        if ret < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                select.select([], [sock], [])
+                continue
+            raise OSError(err, os.strerror(err))
+        sent += ret
+
 class AbletonOSCClient:
-    def __init__(self, ip=ABLETON_IP, port=ABLETON_PORT):
+    def __init__(self, ip=ABLETON_IP, port=ABLETON_PORT, reply_port=ABLETON_REPLY_PORT):
         self.client = udp_client.SimpleUDPClient(ip, port)
+        self._sock = self.client._sock
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, OSC_SEND_BUFFER)
+        self._sock.setblocking(False)
+        self._addr = (ip, port)
+
+        # Query replies let callers wait on Ableton instead of sleeping; the server starts on first use
+        self._pending = {}
+        self._reply_port = reply_port
+        self._reply_server_failed = False
+        self.server = None
+
+        # AbletonOSC accepts (pitch, start, duration, velocity, mute) repeated after track/clip in one message,
+        # so the address and track/clip are sent once per datagram instead of once per note
+        self._note_address = osc_types.write_string("/live/clip/add/notes")
+        self._note_record = np.dtype(NOTE_FIELDS)
+        self._notes_per_message = 1
+        while self._note_message_size(self._notes_per_message + 1) <= OSC_MAX_DATAGRAM:
+            self._notes_per_message += 1
 
     def create_clip(self, track_index, clip_index):
         """Creates a MIDI clip in the specified slot."""
         print(f"Creating clip at Track {track_index}, Slot {clip_index}...")
-        self.client.send_message("/live/clip_slot/create_clip", [track_index, clip_index, LENGTH * CHORD_DURATION])
+        self._send_message("/live/clip_slot/create_clip", [track_index, clip_index, LENGTH * CHORD_DURATION])
+
+    def add_notes(self, track_index, clip_index, pitches, starts, durations, velocity=100):
+        """
+        Sends notes to an Ableton clip as multi-note messages, each filling at most one UDP datagram.
+        'pitches', 'starts' and 'durations' are parallel arrays with one entry per note.
+        """
+        records = np.empty(len(pitches), dtype=self._note_record)
+        records["pitch"] = pitches
+        records["start"] = starts
+        records["duration"] = durations
+        records["velocity"] = velocity
+
+        # Serialize every note in one pass, then cut the bytes into message-sized slices
+        data = records.tobytes()
+        size = self._note_record.itemsize
+        target = struct.pack(">ii", track_index, clip_index)
+        datagrams = []
+        for i in range(0, len(records), self._notes_per_message):
+            count = min(self._notes_per_message, len(records) - i)
+            datagrams.append(self._note_header(count) + target + data[i * size:(i + count) * size])
+
+        print(f"Adding {len(records)} notes in {len(datagrams)} message(s)...")
+        _send_datagrams(self._sock, self._addr, datagrams)
+
+    def _note_header(self, count):
+        """Address and type tags of an add-notes message carrying 'count' notes."""
+        return self._note_address + osc_types.write_string(",ii" + "iffiF" * count)
 
-    def add_notes(self, track_index, clip_index, notes):
+    def _note_message_size(self, count):
+        """Datagram size of an add-notes message carrying 'count' notes."""
+        return len(self._note_header(count)) + 8 + count * self._note_record.itemsize
+
+    def wait_for_clip(self, track_index, clip_index, timeout=0.2):
+        """Waits until Ableton reports a clip in the slot. Returns False on timeout."""
+        return self._wait_for(
+            "/live/clip_slot/get/has_clip", [track_index, clip_index],
+            lambda args: tuple(args[:2]) == (track_index, clip_index) and bool(args[2]),
+            timeout)
+
+    def wait_for_notes(self, track_index, clip_index, timeout=0.5):
+        """Waits until Ableton has applied the notes sent so far to the clip. Returns False on timeout."""
+        # AbletonOSC handles messages in order, so any reply to a query sent after add_notes means the notes
+        # are in. Don't compare note counts: Live merges notes that share pitch and start time.
+        return self._wait_for(
+            "/live/clip/get/notes", [track_index, clip_index],
+            lambda args: tuple(args[:2]) == (track_index, clip_index),
+            timeout)
+
+    def _wait_for(self, address, args, done, timeout):
         """
-        Sends notes to an Ableton clip serially.
-        'notes' should be a list of (pitch, start_time, duration, velocity)
+        Re-sends the query 'address' every QUERY_INTERVAL until a reply satisfies 'done' or 'timeout' passes.
+        Without a reply server this just waits out the timeout, like the old fixed delays.
         """
-        print(f"Adding {len(notes)} notes serially...")
-        for note in notes:
-            pitch, start, duration, velocity = note
-            self.client.send_message("/live/clip/add/notes", [track_index, clip_index, pitch, start, duration, velocity, False])
+        if not self._start_reply_server():
+            time.sleep(timeout)
+            return False
+
+        event = threading.Event()
+        self._pending[address] = (done, event)
+        deadline = time.monotonic() + timeout
+        try:
+            while not event.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._send_message(address, args)
+                event.wait(min(QUERY_INTERVAL, remaining))
+            return True
+        finally:
+            self._pending.pop(address, None)
+
+    def _start_reply_server(self):
+        """
+        Starts listening for query replies on all interfaces, once. Returns False if the port can't be bound.
+        Deferred until the first query so that creating a client (or importing this module) binds nothing.
+        """
+        if self.server is None and not self._reply_server_failed:
+            dispatcher = Dispatcher()
+            dispatcher.set_default_handler(self._on_reply)
+            try:
+                self.server = osc_server.ThreadingOSCUDPServer(("0.0.0.0", self._reply_port), dispatcher)
+                threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            except OSError as e:
+                self._reply_server_failed = True
+                print(f"Could not listen for Ableton replies on port {self._reply_port} ({e}); falling back to fixed delays.")
+        return self.server is not None
+
+    def _on_reply(self, address, *args):
+        pending = self._pending.get(address)
+        if pending is not None and pending[0](args):
+            pending[1].set()
 
     def fire_clip(self, track_index, clip_index):
         """Launches the clip."""
         print(f"Firing clip at Track {track_index}, Slot {clip_index}...")
-        self.client.send_message("/live/clip_slot/fire", [track_index, clip_index])
+        self._send_message("/live/clip_slot/fire", [track_index, clip_index])
+
+    def _send_message(self, address, args):
+        """Sends a single OSC message through the non-blocking socket."""
+        msg = osc_message_builder.OscMessageBuilder(address=address)
+        for arg in args:
+            msg.add_arg(arg)
+        _send_datagrams(self._sock, self._addr, [msg.build().dgram])
+
+# Shared client so every keypress reuses the same UDP socket
+OSC = AbletonOSCClient()
 
 # --- 3. QUANTUM ENGINE ---
+# One long-lived simulator for every draw, so Aer's thread pool and caches survive between keypresses
+# The QRNG circuits are H + measure only (Clifford), so the stabilizer method simulates them exactly
+_SIM = AerSimulator(method="stabilizer", max_parallel_threads=os.cpu_count())
+_RNG = np.random.default_rng()
+
+@functools.lru_cache(maxsize=None)
+def _build_circuit(num_qubits):
+    """
+    Builds (once per qubit count) a circuit that puts every qubit in superposition and measures it.
+    H and measure run natively on the stabilizer method, so the circuit is not transpiled.
+    """
+    qc = QuantumCircuit(num_qubits)
+    qc.h(range(num_qubits))
+    qc.measure_all()
+    return qc
+
+def _run_shots(sim, qc, shots):
+    """
+    Runs 'qc' and returns one measured integer per shot, in random order.
+    Only the counts histogram (at most 2**n entries) crosses back from Aer; NumPy expands it.
+    """
+    counts = sim.run(qc, shots=shots).result().get_counts()
+    vals = np.repeat(np.array([int(bitstring, 2) for bitstring in counts], dtype=int), list(counts.values()))
+    _RNG.shuffle(vals)
+    return vals
+
 def get_quantum_indices(num_notes):
     """
     Generates a list of random indices (0-3) using a Quantum Circuit.
     """
-    qc = QuantumCircuit(2)
-    qc.h([0, 1])
-    qc.measure_all()
-    
-    sim = AerSimulator()
-    job = sim.run(qc, shots=num_notes, memory=True)
-    result = job.result()
-    memory = result.get_memory()
-    
-    indices = [int(bitstring, 2) for bitstring in memory]
-    return indices
+    return _run_shots(_SIM, _build_circuit(2), num_notes)
 
 def get_quantum_random_numbers(count, max_value):
     """
     Generates 'count' random numbers between 0 and max_value-1 using a quantum circuit.
     """
     import math
-    if max_value <= 0: return []
-    if max_value == 1: return [0] * count
+    if max_value <= 0: return np.empty(0, dtype=int)
+    if max_value == 1: return np.zeros(count, dtype=int)
     
     num_qubits = math.ceil(math.log2(max_value))
-    generated_numbers = []
+    batches = [np.empty(0, dtype=int)]  # Keeps concatenate valid when count is 0
+    generated = 0
     
     print(f"Generating {count} numbers in range [0, {max_value-1}] using {num_qubits} qubits...")
     
-    sim = AerSimulator()
+    qc = _build_circuit(num_qubits)
     
-    while len(generated_numbers) < count:
-        batch_size = (count - len(generated_numbers)) * 2 
+    while generated < count:
+        # Size the run so one batch covers the rejections with a 20% margin; a re-run is rare
+        needed = count - generated
+        shots = int(needed * (2 ** num_qubits) / max_value * 1.2) + 32
         
-        qc = QuantumCircuit(num_qubits)
-        qc.h(range(num_qubits))
-        qc.measure_all()
-        
-        job = sim.run(qc, shots=batch_size, memory=True)
-        result = job.result()
-        memory = result.get_memory()
-        
-        for bitstring in memory:
-            val = int(bitstring, 2)
-            if val < max_value:
-                generated_numbers.append(val)
-                if len(generated_numbers) == count:
-                    break
+        vals = _run_shots(_SIM, qc, shots)
+        vals = vals[vals < max_value]
+        batches.append(vals)
+        generated += len(vals)
                     
-    return generated_numbers
+    return np.concatenate(batches)[:count]
+
+def get_quantum_note_indices(count, num_pitches, num_durations):
+    """
+    Generates 'count' (pitch index, duration index) pairs from a single combined circuit.
+    The low qubits of each shot select the pitch and the high qubits select the duration.
+    """
+    import math
+    pitch_qubits = math.ceil(math.log2(num_pitches))
+    duration_qubits = math.ceil(math.log2(num_durations))
+    num_qubits = pitch_qubits + duration_qubits
+    pitch_batches = [np.empty(0, dtype=int)]  # Keeps concatenate valid when count is 0
+    duration_batches = [np.empty(0, dtype=int)]
+    generated = 0
+    
+    print(f"Generating {count} pitch/duration pairs using {num_qubits} qubits...")
+    
+    qc = _build_circuit(num_qubits)
+    
+    while generated < count:
+        needed = count - generated
+        shots = int(needed * (2 ** num_qubits) / (num_pitches * num_durations) * 1.2) + 32
+        
+        vals = _run_shots(_SIM, qc, shots)
+        pitches = vals & ((1 << pitch_qubits) - 1)
+        durations = vals >> pitch_qubits
+        keep = (pitches < num_pitches) & (durations < num_durations)
+        pitch_batches.append(pitches[keep])
+        duration_batches.append(durations[keep])
+        generated += int(keep.sum())
+    
+    return np.concatenate(pitch_batches)[:count], np.concatenate(duration_batches)[:count]
 
 # --- 4. MUSIC GENERATION & ABLETON SYNC ---
 def generate_and_sync(track_index):
-    # Setup progression
-    print(f"Selecting {LENGTH} chords using Quantum Randomness...")
-    chord_indices = get_quantum_random_numbers(LENGTH, len(CHORDS))
-    progression = [CHORDS[i] for i in chord_indices]
-
     # Total notes needed
     total_notes_needed = LENGTH * NOTES_PER_CHORD
     
-    # Poll quantum engine for pitches and durations
-    print(f"Generating quantum pitches for {total_notes_needed} notes...")
-    q_pitch_indices = get_quantum_random_numbers(total_notes_needed, 4)
-    
-    print(f"Generating quantum durations for {total_notes_needed} notes...")
-    q_duration_indices = get_quantum_random_numbers(total_notes_needed, len(DURATIONS))
-    
-    notes_for_osc = []
-    current_time = 0.0
-    q_counter = 0
+    if USE_QUANTUM:
+        print(f"Selecting {LENGTH} chords and generating quantum pitches/durations for {total_notes_needed} notes...")
+        chord_indices = get_quantum_random_numbers(LENGTH, len(CHORDS))
+        q_pitch_indices, q_duration_indices = get_quantum_note_indices(total_notes_needed, 4, len(DURATIONS))
+    else:
+        print(f"Selecting {LENGTH} chords and generating pitches/durations for {total_notes_needed} notes (classical PRNG)...")
+        chord_indices = _RNG.integers(0, len(CHORDS), size=LENGTH)
+        q_pitch_indices = _RNG.integers(0, 4, size=total_notes_needed)
+        q_duration_indices = _RNG.integers(0, len(DURATIONS), size=total_notes_needed)
+    progression_ext = EXTENDED_CHORDS[chord_indices]
     
     print(f"Generating quantum melody (BPM: {TEMPO}, Density: {NOTES_PER_CHORD} notes/bar)...")
     
-    for chord in progression:
-        # Simple voicing: Triad + Octave root
-        extended_chord = chord + [chord[0] + 12]
-        
-        for _ in range(NOTES_PER_CHORD):
-            # Select Pitch
-            note_index = q_pitch_indices[q_counter]
-            note_pitch = extended_chord[note_index]
-            
-            # Select Duration
-            dur_index = q_duration_indices[q_counter]
-            note_duration = DURATIONS[dur_index]
-            
-            # Store for OSC: (pitch, start_time_beats, duration_beats, velocity)
-            notes_for_osc.append((note_pitch, current_time, note_duration, 100))
-            
-            # Increment time
-            current_time += note_duration
-            q_counter += 1
+    # Gather every note's pitch and duration at once, then lay notes back to back
+    bar_of_note = np.repeat(np.arange(LENGTH), NOTES_PER_CHORD)
+    pitches = progression_ext[bar_of_note, q_pitch_indices]
+    durations = DURATION_VALUES[q_duration_indices]
+    starts = np.cumsum(durations) - durations
+    current_time = durations.sum()
             
     # --- ABLETON INTEGRATION ---
     try:
-        print("Connecting to Ableton...")
-        osc = AbletonOSCClient()
-        
         # Create Clip
-        osc.create_clip(track_index, CLIP_INDEX)
+        OSC.create_clip(track_index, CLIP_INDEX)
         
-        # Small delay to ensure clip creation is processed
-        time.sleep(0.2)
+        # Wait for Ableton to confirm the clip exists
+        if not OSC.wait_for_clip(track_index, CLIP_INDEX):
+            print("No clip confirmation from Ableton; sending notes anyway.")
         
-        # Send notes serially
-        osc.add_notes(track_index, CLIP_INDEX, notes_for_osc)
+        # Send notes as batched multi-note messages
+        OSC.add_notes(track_index, CLIP_INDEX, pitches, starts, durations)
         
-        # Small delay before firing
-        time.sleep(0.5)
-        osc.fire_clip(track_index, CLIP_INDEX)
+        # Wait for Ableton to confirm the notes before firing
+        if not OSC.wait_for_notes(track_index, CLIP_INDEX):
+            print("Ableton did not confirm the notes; firing anyway.")
+        OSC.fire_clip(track_index, CLIP_INDEX)
         
         print(f"Quantum Melody sent to Track {track_index} ({current_time} beats) and fired in Ableton.")
         
@@ -173,13 +408,34 @@ def generate_and_sync(track_index):
         print(f"Could not connect to Ableton or send OSC: {e}")
         print("Ensure Ableton Live is running and AbletonOSC remote script is active.")
 
-def on_space_pressed(event):
+def _generation_worker():
+    """Runs generations one at a time, off the keyboard hook thread."""
     global current_track_index
-    print(f"\n--- Space Bar Pressed! Generating for Track {current_track_index} ---")
-    generate_and_sync(current_track_index)
-    current_track_index += 1
-    print(f"Next track will be: {current_track_index}")
-    print("Press SPACE to generate another track, or ESC to exit.")
+    while True:
+        _generate_requests.get()
+        print(f"\n--- Space Bar Pressed! Generating for Track {current_track_index} ---")
+        try:
+            generate_and_sync(current_track_index)
+        except Exception as e:
+            # Keep the worker alive so the next press still works
+            print(f"Could not generate for Track {current_track_index}: {e}")
+            print("Press SPACE to try again, or ESC to exit.")
+            continue
+        current_track_index += 1
+        print(f"Next track will be: {current_track_index}")
+        print("Press SPACE to generate another track, or ESC to exit.")
+
+def on_space_pressed(event):
+    """Debounces the space bar and queues a generation; returns immediately."""
+    global _last_trigger
+    now = time.monotonic()
+    if now - _last_trigger < DEBOUNCE_SECONDS:
+        return
+    _last_trigger = now
+    try:
+        _generate_requests.put_nowait(None)
+    except queue.Full:
+        pass  # A generation is already queued behind the running one
 
 if __name__ == "__main__":
     print("Quantum Music Generator Started!")
@@ -187,8 +443,12 @@ if __name__ == "__main__":
     print("Press SPACE to generate a new quantum melody for the next track.")
     print("Press ESC to exit.")
     
-    # Hook the space bar
-    keyboard.on_press_key("space", on_space_pressed)
+    # Generate on a background worker so the keyboard hook never blocks
+    threading.Thread(target=_generation_worker, daemon=True).start()
+    
+    # Hook the space bar. The handler still runs on every key-down, auto-repeat included; on_space_pressed debounces.
+    # suppress=True hides SPACE from every app while this runs, including Live's own play/stop shortcut.
+    keyboard.add_hotkey("space", lambda: on_space_pressed(None), suppress=True, trigger_on_release=False)
     
     # Wait for the ESC key to exit the program
     keyboard.wait("esc")